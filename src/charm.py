@@ -4,7 +4,9 @@
 
 """Charmed Operator for launchpad retracers."""
 
+import functools
 import logging
+import re
 import shutil
 from subprocess import CalledProcessError
 
@@ -20,6 +22,10 @@ logger = logging.getLogger(__name__)
 
 PORT = 80
 
+ARCHITECTURE_RE = re.compile(r"[a-z0-9]+")
+# Upper bound on configured architectures, each one gets its own worker units
+MAX_ARCHITECTURES = 16
+
 
 class LaunchpadRetracerCharm(ops.CharmBase):
     """Charmed Operator for Launchpad Retracers."""
@@ -39,7 +45,12 @@ class LaunchpadRetracerCharm(ops.CharmBase):
         self.framework.observe(self.ingress.on.ready, self._on_config_changed)
         self.framework.observe(self.ingress.on.revoked, self._on_config_changed)
 
-        self._retracer = Retracer()
+        self._arch_cache: list[str] | None = None
+
+    @functools.cached_property
+    def _retracer(self) -> Retracer:
+        """Lazily create the retracer only for events that need the workload."""
+        return Retracer()
 
     def _on_install(self, event: ops.EventBase):
         """Handle install, upgrade, config-changed, or ingress events."""
@@ -134,10 +145,25 @@ class LaunchpadRetracerCharm(ops.CharmBase):
         self.unit.status = ops.ActiveStatus()
 
     def _get_architectures(self) -> list[str]:
-        """Get and validate the architectures configuration."""
-        architectures = self.config["architectures"].split()
+        """Get and validate the architectures configuration.
+
+        The parsed list is cached on the charm instance, which only lives for a single
+        event dispatch.
+        """
+        if self._arch_cache is not None:
+            return self._arch_cache
+        # Drop duplicates while keeping the configured order
+        architectures = list(dict.fromkeys(self.config["architectures"].split()))
         if not architectures:
             raise ValueError("Config 'architectures' cannot be empty.")
+        if len(architectures) > MAX_ARCHITECTURES:
+            raise ValueError(
+                f"Config 'architectures' cannot list more than {MAX_ARCHITECTURES} entries."
+            )
+        invalid = [arch for arch in architectures if not ARCHITECTURE_RE.fullmatch(arch)]
+        if invalid:
+            raise ValueError(f"Config 'architectures' has invalid entries: {invalid}")
+        self._arch_cache = architectures
         return architectures
 
 
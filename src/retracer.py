@@ -3,17 +3,19 @@
 
 """Representation of the retracer service."""
 
-import glob
+import functools
 import logging
 import os
+import pwd
 import shutil
+import stat
 from pathlib import Path
 from subprocess import PIPE, STDOUT, CalledProcessError, run
 
 import charms.operator_libs_linux.v1.systemd as systemd
 import requests
 from charmlibs import apt
-from charmlibs.apt import PackageError, PackageNotFoundError
+from charmlibs.apt import PackageError
 
 logger = logging.getLogger(__name__)
 
@@ -32,29 +34,80 @@ PACKAGES = [
 RETRACER_CONFIG_LOCATION = Path("/app/config-apport")
 RETRACER_CONFIG_URL = "https://git.launchpad.net/~ubuntu-archive/+git/lp-retracer-config"
 
+# Proxy protocols and the Juju model config variables providing them.
+JUJU_PROXY_VARS = (
+    ("http", "JUJU_CHARM_HTTP_PROXY"),
+    ("https", "JUJU_CHARM_HTTPS_PROXY"),
+)
+
 SRVDIR = Path("/srv/retracers")
 LP_CREDENTIALS = Path("/app/launchpad-credentials")
+WORKLOAD_VERSION_CACHE = Path("/app/.apport-retrace.version")
+APPORT_DPKG_LIST = Path("/var/lib/dpkg/info/apport-retrace.list")
 
 NGINX_SITE_CONFIG_PATH = Path("/etc/nginx/conf.d/crashdb.conf")
 
+SYSTEMD_TEMPLATES_DIR = Path(__file__).parent / "systemd"
+SYSTEMD_TEMPLATE_NAMES = (
+    "launchpad-retracer-dupcheck.service",
+    "launchpad-retracer-dupcheck.timer",
+    "launchpad-retracer-worker@.service",
+    "launchpad-retracer-worker@.timer",
+)
+
+# Buffer size used when streaming the crashdb to disk.
+CRASHDB_COPY_BUFSIZE = 1 << 20
+
+
+@functools.cache
+def _ubuntu_ids() -> tuple[int, int]:
+    """Return the uid and gid of the unprivileged ubuntu user running the workload."""
+    pw = pwd.getpwnam("ubuntu")
+    return pw.pw_uid, pw.pw_gid
+
+
+def _ensure_ubuntu_dir(path: Path):
+    """Create a directory owned by the ubuntu user, unless it already is."""
+    uid, gid = _ubuntu_ids()
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        path.mkdir(parents=True)
+        logger.debug("Directory %s created", path)
+    else:
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(f"{path} exists and is not a directory")
+        if st.st_uid == uid and st.st_gid == gid:
+            return
+    os.chown(path, uid, gid)
+
+
+@functools.cache
+def _systemd_template(name: str) -> str:
+    """Read a systemd unit template shipped with the charm, once per process."""
+    return (SYSTEMD_TEMPLATES_DIR / name).read_text()
+
 
 class Retracer:
     """Represent a retracer instance in the workload."""
 
     def __init__(self):
         logger.debug("Retracer class init")
-        self.env = os.environ.copy()
-        self.proxies = {}
-        juju_http_proxy = self.env.get("JUJU_CHARM_HTTP_PROXY")
-        juju_https_proxy = self.env.get("JUJU_CHARM_HTTPS_PROXY")
-        if juju_http_proxy:
-            logger.debug("Setting HTTP_PROXY env to %s", juju_http_proxy)
-            self.env["HTTP_PROXY"] = juju_http_proxy
-            self.proxies["http"] = juju_http_proxy
-        if juju_https_proxy:
-            logger.debug("Setting HTTPS_PROXY env to %s", juju_https_proxy)
-            self.env["HTTPS_PROXY"] = juju_https_proxy
-            self.proxies["https"] = juju_https_proxy
+        self.proxies = {
+            proto: os.environ[var] for proto, var in JUJU_PROXY_VARS if os.environ.get(var)
+        }
+        # Only copy the environment when it needs to be amended
+        self.env = os.environ.copy() if self.proxies else os.environ
+        for proto, proxy in self.proxies.items():
+            logger.debug("Setting %s_PROXY env to %s", proto.upper(), proxy)
+            self.env[f"{proto.upper()}_PROXY"] = proxy
+
+        # Proxy environment appended to the systemd service units
+        self._systemd_proxy = "".join(
+            f"\nEnvironment={name}_proxy={proxy}"
+            for proto, proxy in self.proxies.items()
+            for name in (proto, proto.upper())
+        )
 
     def install(self, architectures: list[str]):
         """Install the retracer environment."""
@@ -65,6 +118,7 @@ class Retracer:
         self._download_crashdb()
         self._setup_systemd_units(architectures)
         self._nginx_config()
+        self._write_workload_version()
 
     def configure(self, architectures: list[str]):
         """Configure the retracer for the given architectures."""
@@ -86,8 +140,8 @@ class Retracer:
         try:
             fd = os.open(LP_CREDENTIALS, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
             with os.fdopen(fd, "w", encoding="utf-8") as f:
+                os.fchown(fd, *_ubuntu_ids())
                 f.write(lpcredentials)
-            shutil.chown(LP_CREDENTIALS, "ubuntu", "ubuntu")
         except OSError as e:
             logger.debug("Error creating launchpad credentials: %s", e)
             raise
@@ -105,106 +159,121 @@ class Retracer:
             logger.error("Failed to update package cache: %s", e)
             raise
 
-        for p in PACKAGES:
-            try:
-                apt.add_package(p)
-                logger.debug("Package %s installed", p)
-            except PackageNotFoundError:
-                logger.error("Failed to find package %s in package cache", p)
-                raise
-            except PackageError as e:
-                logger.error("Failed to install %s: %s", p, e)
-                raise
+        try:
+            logger.debug("Installing packages: %s", ", ".join(PACKAGES))
+            apt.add_package(PACKAGES)
+            logger.debug("Packages installed")
+        except PackageError as e:
+            logger.error("Failed to install packages: %s", e)
+            raise
 
     def _setup_systemd_units(self, architectures: list[str]):
         """Set up the systemd service and timer."""
         systemd_unit_location = Path("/etc/systemd/system")
         systemd_unit_location.mkdir(parents=True, exist_ok=True)
 
-        systemd_proxy = ""
-        for proto, proxy in self.proxies.items():
-            systemd_proxy += f"\nEnvironment={proto}_proxy={proxy}"
-            systemd_proxy += f"\nEnvironment={proto.upper()}_proxy={proxy}"
-
-        # Dupcheck units
-        systemd_service = Path("src/systemd/launchpad-retracer-dupcheck.service")
-        service_txt = systemd_service.read_text()
-        systemd_timer = Path("src/systemd/launchpad-retracer-dupcheck.timer")
-        timer_txt = systemd_timer.read_text()
-
-        (systemd_unit_location / "launchpad-retracer-dupcheck.service").write_text(
-            service_txt + systemd_proxy
-        )
-        (systemd_unit_location / "launchpad-retracer-dupcheck.timer").write_text(timer_txt)
-
-        # Worker units
-        worker_service_txt = Path("src/systemd/launchpad-retracer-worker@.service").read_text()
-        worker_timer_txt = Path("src/systemd/launchpad-retracer-worker@.timer").read_text()
-
-        (systemd_unit_location / "launchpad-retracer-worker@.service").write_text(
-            worker_service_txt + systemd_proxy
-        )
-        (systemd_unit_location / "launchpad-retracer-worker@.timer").write_text(worker_timer_txt)
+        for name in SYSTEMD_TEMPLATE_NAMES:
+            text = _systemd_template(name)
+            if name.endswith(".service"):
+                text += self._systemd_proxy
+            (systemd_unit_location / name).write_text(text)
         systemd.daemon_reload()
 
-        # Enable units
-        systemd.service_enable("--now", "launchpad-retracer-dupcheck.timer")
-
         # Handle architecture changes
-        active_timers = glob.glob(
-            "/etc/systemd/system/timers.target.wants/launchpad-retracer-worker@*.timer"
+        prefix, suffix = "launchpad-retracer-worker@", ".timer"
+        try:
+            with os.scandir(systemd_unit_location / "timers.target.wants") as it:
+                current_archs = {
+                    e.name[len(prefix) : -len(suffix)]
+                    for e in it
+                    if e.name.startswith(prefix) and e.name.endswith(suffix)
+                }
+        except FileNotFoundError:
+            current_archs = set()
+        wanted_archs = set(architectures)
+
+        # Enable units in a single systemctl call, already enabled timers are only
+        # included when they are no longer running
+        new_timers = [
+            f"launchpad-retracer-worker@{arch}.timer"
+            for arch in sorted(wanted_archs - current_archs)
+        ]
+        new_timers += self._inactive_units(
+            [
+                f"launchpad-retracer-worker@{arch}.timer"
+                for arch in sorted(wanted_archs & current_archs)
+            ]
         )
-        current_archs = [t.split("@")[1].split(".")[0] for t in active_timers]
-
-        # Enable units
-        for arch in architectures:
-            systemd.service_enable("--now", f"launchpad-retracer-worker@{arch}.timer")
-
-        # Disable and clean up retired ones
-        for arch in current_archs:
-            if arch not in architectures:
-                try:
-                    systemd.service_stop(f"launchpad-retracer-worker@{arch}.timer")
-                    systemd.service_stop(f"launchpad-retracer-worker@{arch}.service")
-                    systemd.service_disable(f"launchpad-retracer-worker@{arch}.timer")
-                    (systemd_unit_location / f"launchpad-retracer-worker@{arch}.timer").unlink(
-                        missing_ok=True
-                    )
-                    (systemd_unit_location / f"launchpad-retracer-worker@{arch}.service").unlink(
-                        missing_ok=True
-                    )
-                    logger.debug("Disabled and cleaned up retired worker for %s", arch)
-                except Exception as e:
-                    logger.warning("Failed to disable retired worker for %s: %s", arch, e)
+        systemd.service_enable("--now", "launchpad-retracer-dupcheck.timer", *new_timers)
+
+        # Disable and clean up retired ones, one systemctl call per step when possible
+        retired_archs = sorted(current_archs - wanted_archs)
+        if retired_archs:
+            retired_timers = [f"launchpad-retracer-worker@{arch}.timer" for arch in retired_archs]
+            retired_services = [
+                f"launchpad-retracer-worker@{arch}.service" for arch in retired_archs
+            ]
+            try:
+                systemd.service_stop(*retired_timers, *retired_services)
+                systemd.service_disable(*retired_timers)
+                for unit in retired_timers + retired_services:
+                    (systemd_unit_location / unit).unlink(missing_ok=True)
+                logger.debug("Disabled and cleaned up retired workers for %s", retired_archs)
+            except Exception as e:
+                logger.debug("Batched retirement failed, retrying per architecture: %s", e)
+                for arch in retired_archs:
+                    self._retire_worker(systemd_unit_location, arch)
 
         logger.debug("Systemd units synchronized")
 
+    def _inactive_units(self, units: list[str]) -> list[str]:
+        """Return the given units that are not active, using a single systemctl call."""
+        if not units:
+            return []
+        # is-active prints one state per unit and exits non-zero if any is inactive
+        result = run(
+            ["systemctl", "is-active", *units], capture_output=True, text=True, env=self.env
+        )
+        states = result.stdout.split()
+        if len(states) != len(units):
+            logger.debug("Unexpected systemctl is-active output: %s", result.stdout)
+            return units
+        return [unit for unit, state in zip(units, states) if state != "active"]
+
+    def _retire_worker(self, systemd_unit_location: Path, arch: str):
+        """Stop, disable and remove the worker units of a single architecture."""
+        try:
+            systemd.service_stop(f"launchpad-retracer-worker@{arch}.timer")
+            systemd.service_stop(f"launchpad-retracer-worker@{arch}.service")
+            systemd.service_disable(f"launchpad-retracer-worker@{arch}.timer")
+            (systemd_unit_location / f"launchpad-retracer-worker@{arch}.timer").unlink(
+                missing_ok=True
+            )
+            (systemd_unit_location / f"launchpad-retracer-worker@{arch}.service").unlink(
+                missing_ok=True
+            )
+            logger.debug("Disabled and cleaned up retired worker for %s", arch)
+        except Exception as e:
+            logger.warning("Failed to disable retired worker for %s: %s", arch, e)
+
     def _create_directories(self, architectures: list[str]):
         """Create the directories needed for the retracer."""
         try:
-            SRVDIR.mkdir(parents=True, exist_ok=True)
-            shutil.chown(SRVDIR, "ubuntu", "ubuntu")
-            logger.debug("Directory %s created", SRVDIR)
+            _ensure_ubuntu_dir(SRVDIR)
         except OSError as e:
             logger.error("Setting up %s directory failed: %s", SRVDIR, e)
             raise
 
-        publish_db_dir = SRVDIR / "apport-duplicates"
-        publish_db_dir.mkdir(parents=True, exist_ok=True)
-        shutil.chown(publish_db_dir, "ubuntu", "ubuntu")
+        _ensure_ubuntu_dir(SRVDIR / "apport-duplicates")
 
         ubuntu_home = Path("/home/ubuntu")
         for arch in architectures:
-            cache_dir = ubuntu_home / f"cache-{arch}"
-            cache_dir.mkdir(parents=True, exist_ok=True)
-            shutil.chown(cache_dir, "ubuntu", "ubuntu")
+            _ensure_ubuntu_dir(ubuntu_home / f"cache-{arch}")
 
         # Needed by apport in sandbox mode
         try:
             debugdir = Path("/usr/lib/debug/.dwz")
-            debugdir.mkdir(parents=True, exist_ok=True)
-            shutil.chown(debugdir, "ubuntu", "ubuntu")
-            logger.debug("Directory %s created", debugdir)
+            _ensure_ubuntu_dir(debugdir)
         except OSError as e:
             logger.error("Setting up %s directory failed: %s", debugdir, e)
             raise
@@ -214,7 +283,7 @@ class Retracer:
         wrapper_source = Path("src/scripts/worker-wrapper")
         wrapper_dest = Path("/app/retracer-worker-wrapper")
         try:
-            shutil.copy(wrapper_source, wrapper_dest)
+            shutil.copyfile(wrapper_source, wrapper_dest)
             os.chmod(wrapper_dest, 0o755)
             logger.debug("Worker wrapper script installed.")
         except OSError as e:
@@ -231,6 +300,8 @@ class Retracer:
                 [
                     "git",
                     "clone",
+                    "--depth=1",
+                    "--single-branch",
                     "-b",
                     "main",
                     url,
@@ -247,76 +318,128 @@ class Retracer:
             logger.error("Git clone of the code failed: %s", e.stdout)
             raise
 
+    def _git(self, directory: str, *args: str, stderr: int = STDOUT) -> str:
+        """Run a git command in the given directory and return its output.
+
+        Error output is merged into the returned output unless ``stderr`` says otherwise,
+        commands whose output is parsed should pass ``stderr=PIPE``.
+        """
+        result = run(
+            ["git", "-C", directory, *args],
+            check=True,
+            stdout=PIPE,
+            stderr=stderr,
+            text=True,
+            env=self.env,
+        )
+        return result.stdout
+
+    def _rev_parse(self, directory: str, ref: str) -> str:
+        """Return the commit id a ref points to."""
+        return self._git(directory, "rev-parse", "--verify", ref, stderr=PIPE).strip()
+
     def _update_checkout(self, directory: str):
         """Update a git repository checkout."""
         try:
-            run(
-                [
-                    "git",
-                    "-C",
-                    directory,
-                    "pull",
-                ],
-                check=True,
-                stdout=PIPE,
-                stderr=STDOUT,
-                text=True,
-                env=self.env,
-            )
+            self._git(directory, "fetch", "--depth=1", "origin", "main")
+            if self._rev_parse(directory, "HEAD") == self._rev_parse(directory, "origin/main"):
+                logger.debug("%s checkout already up to date.", directory)
+                return
+            self._git(directory, "reset", "--hard", "origin/main")
             logger.debug("%s checkout updated.", directory)
 
         except CalledProcessError as e:
-            logger.debug("Git pull in the %s directory failed: %s", directory, e.stdout)
+            logger.debug(
+                "Git update in the %s directory failed: %s", directory, e.stderr or e.stdout
+            )
             raise
 
     def get_workload_version(self):
-        """Get the workload version."""
+        """Get the workload version, as recorded at install time when still current."""
         try:
-            result = run(
-                ["dpkg-query", "-W", "-f=${Version}", "apport-retrace"],
-                check=True,
-                stdout=PIPE,
-                stderr=STDOUT,
-                text=True,
-                env=self.env,
-            )
-            workload_version = result.stdout.strip()
-            logger.debug("Current 'apport-retrace' version: %s", workload_version)
-            return workload_version
+            # dpkg rewrites the package file list whenever apport-retrace is upgraded,
+            # so a cache older than it may hold a stale version
+            if WORKLOAD_VERSION_CACHE.stat().st_mtime >= APPORT_DPKG_LIST.stat().st_mtime:
+                return WORKLOAD_VERSION_CACHE.read_text().strip()
+            logger.debug("Cached 'apport-retrace' version is stale, querying dpkg")
+        except OSError:
+            logger.debug("No cached 'apport-retrace' version, querying dpkg")
+        try:
+            return self._query_workload_version()
         except CalledProcessError as e:
             logger.warning("Failed to get 'apport-retrace' version: %s", e.stdout)
             return "unknown"
 
+    def _query_workload_version(self) -> str:
+        """Query dpkg for the installed apport-retrace version."""
+        result = run(
+            ["dpkg-query", "-W", "-f=${Version}", "apport-retrace"],
+            check=True,
+            stdout=PIPE,
+            stderr=STDOUT,
+            text=True,
+            env=self.env,
+        )
+        workload_version = result.stdout.strip()
+        logger.debug("Current 'apport-retrace' version: %s", workload_version)
+        return workload_version
+
+    def _write_workload_version(self):
+        """Record the installed apport-retrace version for later hooks.
+
+        The cache is optional, get_workload_version falls back to dpkg-query without it.
+        """
+        try:
+            version = self._query_workload_version()
+        except (CalledProcessError, OSError) as e:
+            logger.warning("Failed to get 'apport-retrace' version: %s", e)
+            version = None
+        try:
+            if version is None:
+                WORKLOAD_VERSION_CACHE.unlink(missing_ok=True)
+            else:
+                WORKLOAD_VERSION_CACHE.write_text(version)
+        except OSError as e:
+            logger.warning("Failed to cache 'apport-retrace' version: %s", e)
+
     def _download_crashdb(self):
         """Download the crashdb."""
         db_path = SRVDIR / "apport_duplicates.db"
         if db_path.exists():
             logger.debug("Crashdb %s already exists, skipping download.", db_path)
             return
+        # Download next to the final path so an interrupted transfer never
+        # leaves a truncated database behind that would skip later downloads.
+        partial_path = db_path.with_name(db_path.name + ".partial")
         try:
             url = "https://ubuntu-archive-team.ubuntu.com/apport-duplicates/apport_duplicates.db"
             with requests.get(url, stream=True, timeout=60, proxies=self.proxies) as r:
                 r.raise_for_status()
 
-                with open(db_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
+                with open(partial_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=CRASHDB_COPY_BUFSIZE):
                         f.write(chunk)
 
-            shutil.chown(db_path, "ubuntu", "ubuntu")
+            os.chown(partial_path, *_ubuntu_ids())
+            partial_path.replace(db_path)
+            logger.debug("Crashdb downloaded to %s", db_path)
         except requests.RequestException as e:
             logger.error("Could not download the crashdb: %s", e)
+            partial_path.unlink(missing_ok=True)
             raise
         except OSError as e:
             logger.error("Could not write the crashdb to %s: %s", SRVDIR, e)
+            partial_path.unlink(missing_ok=True)
             raise
         except Exception:
             logger.exception("Error in download_crashdb")
+            partial_path.unlink(missing_ok=True)
             raise
 
     def _nginx_config(self):
         """Configure nginx."""
         try:
-            shutil.copy("src/nginx/crashdb.conf", NGINX_SITE_CONFIG_PATH)
+            shutil.copyfile("src/nginx/crashdb.conf", NGINX_SITE_CONFIG_PATH)
             logger.debug("Nginx config copied")
         except (OSError, shutil.Error) as e:
             logger.warning("Error copying files: %s", str(e))
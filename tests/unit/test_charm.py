@@ -21,7 +21,7 @@ from ops.testing import (
     State,
 )
 
-from charm import LaunchpadRetracerCharm
+from charm import MAX_ARCHITECTURES, LaunchpadRetracerCharm
 
 
 @pytest.fixture
@@ -53,6 +53,40 @@ def test_on_install_no_architectures(ctx, base_state):
     )
 
 
+def test_on_install_invalid_architectures(ctx, base_state):
+    state = State(
+        leader=True,
+        config={"architectures": "amd64 ../etc"},
+    )
+    out = ctx.run(ctx.on.install(), state)
+    assert out.unit_status == BlockedStatus(
+        "Failed to set up the environment. Check `juju debug-log` for details."
+    )
+
+
+def test_on_install_too_many_architectures(ctx, base_state):
+    state = State(
+        leader=True,
+        config={"architectures": " ".join(f"arch{i}" for i in range(MAX_ARCHITECTURES + 1))},
+    )
+    out = ctx.run(ctx.on.install(), state)
+    assert out.unit_status == BlockedStatus(
+        "Failed to set up the environment. Check `juju debug-log` for details."
+    )
+
+
+@patch("charm.Retracer.install", autospec=True)
+def test_on_install_duplicate_architectures(install_mock, ctx, base_state):
+    state = State(
+        leader=True,
+        config={"architectures": "arm64 amd64 arm64"},
+    )
+    out = ctx.run(ctx.on.install(), state)
+    assert out.unit_status == ActiveStatus()
+    install_mock.assert_called_once()
+    assert install_mock.call_args.args[1] == ["arm64", "amd64"]
+
+
 @patch("charm.Retracer.install")
 @pytest.mark.parametrize(
     "exception",